@@ -1,23 +1,26 @@
+# Postpone evaluation of annotations: the heavy modules used in them are imported lazily (see below).
+from __future__ import annotations
 import streamlit as st  # Import Streamlit for creating the web app
-import geopandas as gpd  # Import GeoPandas for geospatial data handling
-from shapely.validation import explain_validity  # Import function to explain invalid geometries
-from streamlit_folium import st_folium  # Import st_folium for embedding Folium maps in Streamlit
-import folium  # Import Folium for map visualization
+import streamlit.components.v1 as components  # Import components to embed the pre-rendered map HTML
 from loguru import logger  # Import Loguru for logging
-import concurrent.futures  # Import for parallel processing of geometries
 import time  # Import time module to measure processing time
 from datetime import datetime  # Import datetime for timestamps
 import json  # Import json module for handling JSON data
-from kafka_integration import get_kafka_producer, send_kafka_event  # Import custom Kafka integration functions
+import io  # Import io to wrap the uploaded bytes in a file-like object
+import hashlib  # Import hashlib to build stable cache keys from geometries
+import os  # Import os to check for and atomically replace the persisted history files
+import threading  # Import threading to serialize writes to the shared history files
 
-# INITIALIZE THE KAFKA PRODUCER:
-# This sets up the Kafka connection using our separate module.
-producer = get_kafka_producer()
+# CACHE SIZE:
+# Upper bound on cached entries per function, so caches shared by all sessions don't grow with every upload.
+CACHE_MAX_ENTRIES = 8
 
-# INITIALIZE SESSION STATE FOR VERSION HISTORY:
-# Check if 'versions' exists in session state; if not, initialize it as an empty list.
-if 'versions' not in st.session_state:
-    st.session_state['versions'] = []
+# HISTORY STORAGE:
+# Version history and team comments are persisted to small Parquet files instead of session state.
+VERSIONS_PATH = "versions.parquet"
+COMMENTS_PATH = "comments.parquet"
+# Streamlit runs sessions as threads of one process, so appends to the shared files are serialized.
+HISTORY_LOCK = threading.Lock()
 
 # CONFIGURE LOGGING:
 # Set up Loguru to log messages to "app.log" with rotation after 1MB.
@@ -35,56 +38,248 @@ st.title("🌍 GeoJSON Dashboard")  # Display the main title at the top
 
 # FILE UPLOADER:
 # Create a file uploader widget that accepts files with .geojson or .json extension.
-file = st.file_uploader("Upload your GeoJSON file", type=["geojson", "json"])
+file = st.file_uploader("Upload your GeoJSON file", type=["geojson", "json"], key="geojson_file")
 
-# DEFINE A FUNCTION FOR PARALLEL VALIDATION OF GEOMETRIES:
-def parallel_validate(geom):
+# DEFINE A CACHED FUNCTION FOR THE KAFKA PRODUCER:
+@st.cache_resource(show_spinner=False)
+def get_producer():
     """
-    Validate a single geometry in parallel.
-    Returns a dictionary with:
+    Create the Kafka producer once using our separate module; Streamlit's resource cache
+    keeps it (and its broker connections) alive across reruns and sessions.
+    Returns None if the broker can't be reached; the caller clears the cache in that case.
+    """
+    from kafka_integration import get_kafka_producer
+    return get_kafka_producer()
+
+# DEFINE A CACHED FUNCTION FOR LOADING AND VALIDATING THE FILE:
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_and_validate(file_bytes: bytes, name: str) -> gpd.GeoDataFrame:
+    """
+    Read the uploaded GeoJSON and validate (and repair) its geometries.
+    Cached on the raw file bytes, so widget-triggered reruns skip parsing and GEOS work.
+    Returns the GeoDataFrame with the extra columns:
       - valid: Boolean indicating if the geometry is valid.
-      - issue: Explanation if invalid, otherwise None.
-      - wkt: The Well-Known Text representation of the geometry.
+      - geometry_fixed / valid_fixed: Repaired geometry and its validity (only if any were invalid).
+    """
+    # Read the uploaded GeoJSON file into a GeoDataFrame with pyogrio's Arrow-based reader,
+    # calling it directly instead of going through gpd.read_file's engine and path dispatch.
+    gdf = pyogrio.read_dataframe(io.BytesIO(file_bytes), use_arrow=True)
+    # Log the successful file load.
+    logger.info(f"GeoJSON file {name} loaded successfully.")
+
+    # Validate all geometries with the shapely ufunc directly on the NumPy geometry array.
+    geoms = np.asarray(gdf.geometry.values)
+    valid = shapely.is_valid(geoms)
+    mask = ~valid
+    # 'valid' column indicates whether each geometry is valid.
+    # Issue explanations are computed later, only for the invalid rows that are displayed.
+    gdf['valid'] = valid
+
+    if mask.any():
+        # Run make_valid only on the invalid subset; valid geometries are kept as they are.
+        fixed = geoms.copy()
+        fixed[mask] = shapely.make_valid(geoms[mask])
+        gdf['geometry_fixed'] = gpd.GeoSeries(fixed, index=gdf.index, crs=gdf.crs)
+        # Check if the fixed geometries are now valid; rows that were already valid are not rechecked.
+        valid_fixed = valid.copy()
+        valid_fixed[mask] = shapely.is_valid(fixed[mask])
+        gdf['valid_fixed'] = valid_fixed
+    return gdf
+
+# Layers with more features than this are drawn with pydeck (WebGL) instead of Folium (Leaflet SVG).
+FOLIUM_MAX_FEATURES = 1000
+
+def simplify_for_render(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Simplify geometries with a tolerance relative to the layer extent and keep only
+    the geometry column, so the browser receives fewer coordinates and no attributes.
+    """
+    minx, miny, maxx, maxy = gdf.total_bounds
+    tolerance = max(maxx - minx, maxy - miny) / 2000
+    gdf_render = gdf[['geometry']].copy()
+    gdf_render['geometry'] = gdf.geometry.simplify(tolerance, preserve_topology=True)
+    return gdf_render
+
+def to_wgs84(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Reproject to WGS84 lon/lat (EPSG:4326), which web maps expect, unless it already is."""
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        return gdf.to_crs(4326)
+    return gdf
+
+def map_center(gdf: gpd.GeoDataFrame) -> tuple:
+    """Return the (lat, lon) midpoint of the total bounds (no geometric union needed)."""
+    minx, miny, maxx, maxy = gdf.total_bounds
+    return ((miny + maxy) / 2, (minx + maxx) / 2)
+
+# DEFINE A CACHED FUNCTION FOR RENDERING THE FOLIUM MAP:
+@st.cache_resource(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_map(geometry_key: str, _gdf: gpd.GeoDataFrame) -> str:
+    """
+    Build and render the Folium map for the given GeoDataFrame once and reuse the HTML across reruns,
+    so the embedded GeoJSON is serialized only once.
+    geometry_key identifies the geometries (see geometry_hash); the leading underscore
+    on _gdf tells Streamlit not to hash the frame itself.
+    """
+    # Reproject once, before centering, point extraction and simplification.
+    _gdf = to_wgs84(_gdf)
+    # Create a Folium map centered at the bounding-box center.
+    m = folium.Map(location=map_center(_gdf), zoom_start=10)
+    if (_gdf.geom_type == 'Point').all():
+        # Point-only layers are clustered client-side instead of creating one SVG marker per feature.
+        coordinates = list(zip(_gdf.geometry.y, _gdf.geometry.x))
+        FastMarkerCluster(data=coordinates).add_to(m)
+    else:
+        # Add the simplified geometries as a GeoJSON overlay to the map.
+        folium.GeoJson(simplify_for_render(_gdf).__geo_interface__).add_to(m)
+    return m.get_root().render()
+
+# DEFINE A CACHED FUNCTION FOR RENDERING THE PYDECK MAP:
+@st.cache_resource(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_deck(geometry_key: str, _gdf: gpd.GeoDataFrame) -> str:
+    """
+    Build and render a WebGL (deck.gl) map for large layers once and reuse the HTML across reruns.
+    Takes the same arguments as build_map.
+    """
+    # deck.gl expects WGS84 lon/lat; reproject once before centering and building the layer.
+    _gdf = to_wgs84(_gdf)
+    latitude, longitude = map_center(_gdf)
+    layer = pdk.Layer(
+        "GeoJsonLayer",
+        simplify_for_render(_gdf).__geo_interface__,
+        stroked=True,
+        filled=True,
+        get_fill_color=[51, 136, 255, 80],     # Same blue as the Folium/Leaflet default style
+        get_line_color=[51, 136, 255],
+        line_width_min_pixels=1,
+        point_radius_min_pixels=2,
+    )
+    view_state = pdk.ViewState(latitude=latitude, longitude=longitude, zoom=10)
+    deck = pdk.Deck(layers=[layer], initial_view_state=view_state)
+    return deck.to_html(as_string=True, notebook_display=False)
+
+def geometry_hash(wkb, crs) -> str:
     """
-    return {
-        "valid": geom.is_valid,  # Check if the geometry is valid using Shapely
-        "issue": None if geom.is_valid else explain_validity(geom),  # If not valid, provide an explanation
-        "wkt": geom.wkt  # Convert geometry to its WKT representation
-    }
+    Return a stable digest of the geometries' WKB and their CRS, used as the map and duplicate cache key.
+    The CRS is included because WKB carries only raw coordinates.
+    """
+    digest = hashlib.sha1(b"".join(wkb))
+    digest.update((crs.to_wkt() if crs is not None else "").encode('utf-8'))
+    return digest.hexdigest()
+
+# DEFINE A CACHED FUNCTION FOR DUPLICATE DETECTION:
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def duplicate_mask(geometry_key: str, _wkb, _geometries: np.ndarray) -> np.ndarray:
+    """
+    Flag duplicate geometries once per set of geometries and reuse the result across reruns.
+    geometry_key identifies the geometries (see geometry_hash); _wkb and _geometries are not hashed.
+    """
+    # Exact duplicates: hash the WKB bytes of each geometry (binary equality).
+    exact = _wkb.duplicated(keep=False).to_numpy()
+    # Extend to spatially equal geometries using an STRtree to prune candidates.
+    # Combined into a new array: under pandas copy-on-write, exact may be read-only.
+    return exact | find_spatial_duplicates(_geometries)
+
+def find_spatial_duplicates(geometries: np.ndarray) -> np.ndarray:
+    """
+    Flag geometries that are spatially equal to another one but not binary-equal
+    (e.g. same polygon with a different starting vertex).
+    The STRtree bounding-box query prunes candidate pairs before the GEOS equality check.
+    """
+    tree = STRtree(geometries)
+    left, right = tree.query(geometries)
+    # Keep each unordered pair once and only pairs whose bounds match exactly.
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+    bounds = shapely.bounds(geometries)
+    same_bounds = (bounds[left] == bounds[right]).all(axis=1)
+    left, right = left[same_bounds], right[same_bounds]
+    equal = shapely.equals(geometries[left], geometries[right])
+    flags = np.zeros(len(geometries), dtype=bool)
+    flags[left[equal]] = True
+    flags[right[equal]] = True
+    return flags
+
+# DEFINE FUNCTIONS FOR THE PERSISTED HISTORY:
+def read_history(path: str) -> pd.DataFrame:
+    """Read a persisted history file, or return an empty frame if none exists yet."""
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    return pd.read_parquet(path)
+
+def append_history(path: str, record: dict) -> None:
+    """
+    Append a single record to a persisted history file.
+    The read-concat-write runs under HISTORY_LOCK so concurrent sessions don't lose records,
+    and the new file is written next to the old one and swapped in with os.replace,
+    so readers never see a half-written file.
+    """
+    with HISTORY_LOCK:
+        history = pd.concat([read_history(path), pd.DataFrame([record])], ignore_index=True)
+        tmp_path = f"{path}.tmp"
+        history.to_parquet(tmp_path, engine='pyarrow', index=False)
+        os.replace(tmp_path, path)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_versions() -> pd.DataFrame:
+    """Load the version history (memoized; cleared whenever a version is appended)."""
+    return read_history(VERSIONS_PATH)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_comments() -> pd.DataFrame:
+    """Load the team comments (memoized; cleared whenever a comment is appended)."""
+    return read_history(COMMENTS_PATH)
+
+# Columns added by load_and_validate, hidden from the raw data preview.
+VALIDATION_COLUMNS = ['geometry', 'valid', 'geometry_fixed', 'valid_fixed']
 
 # PROCESS THE FILE IF UPLOADED:
 if file:
+    # LAZY IMPORTS:
+    # The heavy geospatial, mapping and Kafka modules are only imported once a file is uploaded,
+    # so idle page loads don't pay their import cost. Importing here binds them as module globals
+    # for the functions defined above.
+    import geopandas as gpd  # Import GeoPandas for geospatial data handling
+    import pyogrio  # Import pyogrio to read GeoJSON straight into a GeoDataFrame
+    import shapely  # Import Shapely for vectorized geometry validation and repair
+    from shapely.strtree import STRtree  # Import STRtree for the spatial index used in duplicate detection
+    import numpy as np  # Import NumPy for vectorized boolean masks
+    import pandas as pd  # Import pandas for the persisted version history and comments
+    import folium  # Import Folium for map visualization
+    from folium.plugins import FastMarkerCluster  # Import FastMarkerCluster for point-heavy layers
+    import pydeck as pdk  # Import pydeck for WebGL rendering of large layers
+    from kafka_integration import send_kafka_event  # Import custom Kafka integration functions
+
+    # INITIALIZE THE KAFKA PRODUCER:
+    # One producer is kept alive across reruns and sessions (see get_producer).
+    producer = get_producer()
+    if producer is None:
+        # Don't keep the failed result cached (e.g. the broker wasn't ready yet);
+        # the next rerun tries to connect again.
+        get_producer.clear()
+
     try:
         # Record the start time for processing the file.
         start_time = time.time()
         
-        # Read the uploaded GeoJSON file into a GeoDataFrame.
-        gdf = gpd.read_file(file)
-        # Log the successful file load.
-        logger.info("GeoJSON file loaded successfully.")
+        # Load and validate the file (served from the cache on reruns).
+        gdf = load_and_validate(file.getvalue(), file.name)
 
         # SAVE VERSION INFO:
-        # Create a dictionary with the file name and current timestamp, and save it in session state.
-        version_info = {"filename": file.name, "timestamp": datetime.now().isoformat()}
-        st.session_state['versions'].append(version_info)
+        # Create a dictionary with the file name and current timestamp, and persist it once per uploaded file
+        # (not on every rerun). The cached history is cleared so the new version shows up.
+        if st.session_state.get('last_version_file_id') != file.file_id:
+            version_info = {"filename": file.name, "timestamp": datetime.now().isoformat()}
+            append_history(VERSIONS_PATH, version_info)
+            load_versions.clear()
+            st.session_state['last_version_file_id'] = file.file_id
         
         # DISPLAY RAW DATA PREVIEW:
-        # Show a preview of the data without the geometry column (first 10 rows).
+        # Show a preview of the data without the geometry and validation columns (first 10 rows).
         st.subheader("📋 Data Preview (Raw Data)")
-        st.dataframe(gdf.drop(columns='geometry').head(10))
+        st.dataframe(gdf.head(10).drop(columns=VALIDATION_COLUMNS, errors='ignore'), key="raw_preview")
 
-        # GEOMETRY VALIDATION USING PARALLEL PROCESSING:
-        st.subheader("🛠️ Geometry Validation (Parallel Processing)")
-        # Use ThreadPoolExecutor to validate all geometries concurrently.
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(parallel_validate, gdf.geometry))
-        
-        # Append the results of validation to the GeoDataFrame:
-        # 'valid' column indicates whether each geometry is valid.
-        # 'issue' column stores the issue explanation if any.
-        gdf['valid'] = [res["valid"] for res in results]
-        gdf['issue'] = [res["issue"] for res in results]
-        
+        # GEOMETRY VALIDATION USING VECTORIZED OPERATIONS:
+        st.subheader("🛠️ Geometry Validation (Vectorized)")
         # IDENTIFY INVALID GEOMETRIES:
         # Filter the GeoDataFrame to get geometries that are not valid.
         invalid_geometries = gdf[~gdf['valid']]
@@ -92,25 +287,25 @@ if file:
             # Display a warning if invalid geometries are detected.
             st.warning(f"⚠️ Detected {len(invalid_geometries)} invalid geometries.")
             logger.warning(f"Detected {len(invalid_geometries)} invalid geometries.")
-            # Show the issue details for the first few invalid geometries.
-            st.dataframe(invalid_geometries[['issue']].head(10))
+            # Show the issue details for the first few invalid geometries;
+            # the (expensive) explanation is only computed for the displayed rows.
+            preview = invalid_geometries.head(10)
+            preview = preview.assign(issue=shapely.is_valid_reason(np.asarray(preview.geometry.values)))
+            st.dataframe(preview[['issue']], key="invalid_preview")
             
-            # ATTEMPT TO FIX INVALID GEOMETRIES:
-            # Use a zero-width buffer to attempt to correct the geometry.
-            gdf['geometry_fixed'] = gdf.geometry.buffer(0)
-            # Check if the fixed geometries are now valid.
-            gdf['valid_fixed'] = gdf['geometry_fixed'].apply(lambda g: g.is_valid)
+            # CHECK THE FIX ATTEMPT:
+            # Repaired geometries were computed with make_valid in load_and_validate.
             # Identify any geometries that remain invalid after the fix attempt.
             still_invalid = gdf[~gdf['valid_fixed']]
             if still_invalid.empty:
                 # If all geometries are fixed, update the GeoDataFrame to use the fixed geometries.
-                st.success("✅ All geometries successfully fixed using buffer(0).")
+                st.success("✅ All geometries successfully fixed using make_valid.")
                 gdf.set_geometry('geometry_fixed', inplace=True, drop=True)
             else:
                 # If some geometries still cannot be fixed, display an error.
                 st.error(f"❌ {len(still_invalid)} geometries remain invalid after fix attempt.")
                 logger.error(f"{len(still_invalid)} geometries remain invalid after attempted fixes.")
-                st.dataframe(still_invalid[['geometry']].head(10))
+                st.dataframe(still_invalid.head(10)[['geometry']], key="still_invalid_preview")
                 # Filter out the still-invalid geometries and update the GeoDataFrame.
                 gdf = gdf[gdf['valid_fixed']]
                 gdf.set_geometry('geometry_fixed', inplace=True, drop=True)
@@ -121,14 +316,17 @@ if file:
 
         # DUPLICATE GEOMETRY DETECTION:
         st.subheader("🔍 Duplicate Geometry Detection")
-        # Use the duplicated method to detect duplicates based on the 'geometry' column.
-        duplicates = gdf.duplicated(subset='geometry', keep=False)
+        # Key the cached results on a digest of the geometries' WKB.
+        wkb = gdf.geometry.to_wkb()
+        geometry_key = geometry_hash(wkb, gdf.crs)
+        # Detect exact (WKB) and spatially equal duplicates (served from the cache on reruns).
+        duplicates = duplicate_mask(geometry_key, wkb, gdf.geometry.to_numpy())
         duplicate_geometries = gdf[duplicates]
         if not duplicate_geometries.empty:
             # Display a warning if duplicates are found.
             st.warning(f"⚠️ Detected {len(duplicate_geometries)} duplicate geometries.")
             logger.warning(f"Detected {len(duplicate_geometries)} duplicate geometries.")
-            st.dataframe(duplicate_geometries.drop(columns='geometry').head(10))
+            st.dataframe(duplicate_geometries.head(10).drop(columns='geometry'), key="duplicate_preview")
         else:
             # Display a success message if no duplicates are detected.
             st.success("✅ No duplicate geometries detected.")
@@ -137,14 +335,13 @@ if file:
         # MAP VISUALIZATION:
         st.subheader("🗺️ Interactive Map")
         if not gdf.empty:
-            # Calculate the centroid of all geometries to center the map.
-            centroid = gdf.unary_union.centroid
-            # Create a Folium map centered at the calculated centroid.
-            m = folium.Map(location=[centroid.y, centroid.x], zoom_start=10)
-            # Add the GeoDataFrame as a GeoJSON overlay to the map.
-            folium.GeoJson(gdf).add_to(m)
-            # Render the Folium map within the Streamlit app.
-            st_folium(m, width=800, height=500)
+            if len(gdf) > FOLIUM_MAX_FEATURES:
+                # Large layers are drawn on the GPU with pydeck (HTML served from the resource cache on reruns).
+                components.html(build_deck(geometry_key, gdf), width=800, height=500)
+            else:
+                # Embed the pre-rendered Folium map (served from the resource cache on reruns).
+                # Being static HTML, map interactions don't trigger script reruns.
+                components.html(build_map(geometry_key, gdf), width=800, height=500)
             st.success("Geometries visualized successfully!")
             logger.info("Map visualization completed successfully.")
         else:
@@ -158,23 +355,24 @@ if file:
         
         # DISPLAY VERSION HISTORY:
         st.subheader("📂 Version History")
-        st.dataframe(st.session_state['versions'])
+        st.dataframe(load_versions(), key="version_history")
         
         # SIMULATED TEAM COMMENTS SECTION:
         st.subheader("💬 Team Comments")
-        # Initialize the 'comments' in session state if not already present.
-        if 'comments' not in st.session_state:
-            st.session_state['comments'] = []
-        # Provide a text input for entering a comment.
-        comment = st.text_input("Enter your comment")
-        # On clicking the submit button, add the comment with a timestamp to the session state.
-        if st.button("Submit Comment"):
-            st.session_state['comments'].append({
+        # Group the text input and submit button in a form so typing doesn't rerun the script;
+        # it reruns once when the form is submitted.
+        with st.form("comments_form", clear_on_submit=True):
+            comment = st.text_input("Enter your comment", key="c_in")
+            submitted = st.form_submit_button("Submit Comment")
+        # On submit, persist the comment with a timestamp and clear the cached comments.
+        if submitted:
+            append_history(COMMENTS_PATH, {
                 "comment": comment,
                 "timestamp": datetime.now().isoformat()
             })
+            load_comments.clear()
         # Display the comments in a table.
-        st.dataframe(st.session_state['comments'])
+        st.dataframe(load_comments(), key="comments_table")
         
         # PUBLISH A KAFKA EVENT:
         # Create an event dictionary with details of the processed file.
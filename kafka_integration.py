@@ -1,5 +1,5 @@
 from kafka import KafkaProducer  # Imports KafkaProducer from the kafka-python library for producing messages
-import json                     # Imports json to handle serialization of Python objects to JSON strings
+import orjson                   # Imports orjson to serialize Python objects straight to JSON bytes
 import logging                # Imports logging to record info and errors
 
 def get_kafka_producer(bootstrap_servers='kafka:9092'):
@@ -13,10 +13,16 @@ def get_kafka_producer(bootstrap_servers='kafka:9092'):
     
     try:
         # Creates a KafkaProducer instance with the specified bootstrap servers.
-        # The value_serializer converts Python objects to JSON-encoded bytes.
+        # The value_serializer converts Python objects to JSON-encoded (UTF-8) bytes via orjson.
+        # linger_ms/batch_size let the background sender batch events instead of one request per send,
+        # acks=1 waits only for the partition leader and lz4 compresses each batch.
         producer = KafkaProducer(
             bootstrap_servers=bootstrap_servers,
-            value_serializer=lambda v: json.dumps(v).encode('utf-8')
+            value_serializer=orjson.dumps,
+            linger_ms=50,
+            batch_size=32768,
+            acks=1,
+            compression_type='lz4'
         )
         # Log a success message if the producer is initialized properly.
         logging.info("Kafka producer initialized successfully.")
@@ -39,12 +45,14 @@ def send_kafka_event(producer, topic, event):
         return
 
     try:
-        # Sending the event to the given topic.
-        producer.send(topic, event)
-        # Flushing ensures that the message is actually sent out immediately.
-        producer.flush()  # Ensuring the event is sent
-        # Loggs the event that was sent for debugging/confirmation.
-        logging.info(f"Kafka event sent: {event}")
+        # Sending the event to the given topic without blocking on the broker round-trip;
+        # the producer's background thread batches and delivers it (kafka-python's own
+        # exit handler closes the producer, which drains pending sends).
+        future = producer.send(topic, event)
+        # Delivery failures are reported asynchronously.
+        future.add_errback(lambda e: logging.error(f"Error delivering Kafka event: {e}"))
+        # Loggs the event that was queued for debugging/confirmation.
+        logging.info(f"Kafka event queued: {event}")
     except Exception as e:
         # Logs any exception that might occur during the sending of the event.
         logging.error(f"Error sending Kafka event: {e}")